@@ -1,53 +1,74 @@
 from pathlib import Path
+from functools import lru_cache
 import pandas as pd
-import matplotlib.pyplot as plt
 import io
-import base64
 
 
 # --- Загрузка данных (абсолютный путь, чтобы работало всегда) ---
 BASE_DIR = Path(__file__).resolve().parent
 DATA_PATH = BASE_DIR / "cars_clean.csv"
 
-df = pd.read_csv(DATA_PATH)
+# Типы задаём сразу при чтении: компактные nullable-целые для чисел
+# и category для колонок с небольшим числом значений
+CSV_DTYPES = {
+    "year": "Int16",
+    "horsepower": "Int32",
+    "price_usd": "Int32",
+    "brand": "category",
+    "body_type": "category",
+    "fuel_type": "category",
+    "drive_type": "category",
+    "transmission": "category",
+}
 
-# Нормализуем числа
-for col in ["year", "horsepower", "price_usd"]:
-    if col in df.columns:
-        df[col] = pd.to_numeric(df[col], errors="coerce")
+df = pd.read_csv(DATA_PATH, dtype=CSV_DTYPES)
 
 
-def _fig_to_base64(fig) -> str:
-    """Сохраняет matplotlib-figure в PNG(base64) и освобождает память."""
+def _new_figure(figsize):
+    """
+    Создаёт Figure с одной осью.
+    matplotlib импортируется здесь, а не в начале модуля: он тяжёлый,
+    а нужен только для графиков.
+    """
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=figsize)
+    return fig, fig.subplots()
+
+
+def _fig_to_png_bytes(fig) -> bytes:
+    """Сохраняет matplotlib-figure в PNG через Agg (без pyplot)."""
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
     buf = io.BytesIO()
-    fig.savefig(buf, format="png", dpi=150, bbox_inches="tight")
-    plt.close(fig)
-    buf.seek(0)
-    return base64.b64encode(buf.read()).decode("utf-8")
+    # tight_layout вместо bbox_inches="tight": тот даёт второй проход отрисовки
+    fig.tight_layout()
+    FigureCanvasAgg(fig).print_png(buf)
+    return buf.getvalue()
 
 
 # --- 1) Базовая статистика ---
+@lru_cache(maxsize=1)
 def basic_stats() -> dict:
     """
-    Возвращает базовую статистику по данным:
+    Возвращает базовую статистику по данным (считается один раз — df не меняется):
     - total_cars: количество авто
     - mean_price: средняя цена (округление до целого)
     - median_price: медианная цена (округление до целого)
     - popular_brands: топ-5 марок по количеству
     """
-    data = df.dropna(subset=["price_usd"]).copy()
+    prices = df["price_usd"].dropna()
 
     total_cars = int(len(df))
-    mean_price = int(round(data["price_usd"].mean())) if len(data) else 0
-    median_price = int(round(data["price_usd"].median())) if len(data) else 0
-
-    popular_brands = (
-        df["brand"]
-        .fillna("Unknown")
-        .value_counts()
-        .head(5)
-        .to_dict()
-    )
+    mean_price = int(round(prices.mean())) if len(prices) else 0
+    median_price = int(round(prices.median())) if len(prices) else 0
+
+    # fillna по category требует новой категории — поэтому считаем с NaN
+    # и подписываем пропуски уже в результате
+    counts = df["brand"].value_counts(dropna=False).head(5)
+    popular_brands = {
+        ("Unknown" if pd.isna(b) else b): int(n) for b, n in counts.items()
+    }
 
     return {
         "total_cars": total_cars,
@@ -58,71 +79,72 @@ def basic_stats() -> dict:
 
 
 # --- 2) Графики ---
-def price_distribution_by_brand() -> str:
+def price_distribution_by_brand() -> bytes:
     """
     Распределение цен по маркам (boxplot).
-    Возвращает PNG (base64).
+    Возвращает PNG (bytes).
     """
-    data = df.dropna(subset=["brand", "price_usd"]).copy()
+    data = df.dropna(subset=["brand", "price_usd"])
     if data.empty:
-        fig = plt.figure(figsize=(8, 3))
-        plt.text(0.5, 0.5, "Нет данных для графика", ha="center", va="center")
-        plt.axis("off")
-        return _fig_to_base64(fig)
+        fig, ax = _new_figure((8, 3))
+        ax.text(0.5, 0.5, "Нет данных для графика", ha="center", va="center")
+        ax.axis("off")
+        return _fig_to_png_bytes(fig)
 
     brands = sorted(data["brand"].unique())
     prices = [data.loc[data["brand"] == b, "price_usd"].values for b in brands]
 
-    fig = plt.figure(figsize=(10, 4))
-    plt.boxplot(prices, labels=brands, showfliers=True)
-    plt.title("Распределение цен по маркам")
-    plt.xlabel("Марка")
-    plt.ylabel("Цена (USD)")
-    plt.xticks(rotation=30, ha="right")
-    plt.grid(True, axis="y", alpha=0.3)
+    fig, ax = _new_figure((10, 4))
+    ax.boxplot(prices, labels=brands, showfliers=True)
+    ax.set_title("Распределение цен по маркам")
+    ax.set_xlabel("Марка")
+    ax.set_ylabel("Цена (USD)")
+    for label in ax.get_xticklabels():
+        label.set(rotation=30, ha="right")
+    ax.grid(True, axis="y", alpha=0.3)
 
-    return _fig_to_base64(fig)
+    return _fig_to_png_bytes(fig)
 
 
-def price_vs_year() -> str:
+def price_vs_year() -> bytes:
     """
     Зависимость цены от года выпуска (scatter).
-    Возвращает PNG (base64).
+    Возвращает PNG (bytes).
     """
-    data = df.dropna(subset=["year", "price_usd"]).copy()
+    data = df.dropna(subset=["year", "price_usd"])
     if data.empty:
-        fig = plt.figure(figsize=(8, 3))
-        plt.text(0.5, 0.5, "Нет данных для графика", ha="center", va="center")
-        plt.axis("off")
-        return _fig_to_base64(fig)
+        fig, ax = _new_figure((8, 3))
+        ax.text(0.5, 0.5, "Нет данных для графика", ha="center", va="center")
+        ax.axis("off")
+        return _fig_to_png_bytes(fig)
 
-    fig = plt.figure(figsize=(9, 4))
-    plt.scatter(data["year"], data["price_usd"], alpha=0.8)
-    plt.title("Зависимость цены от года выпуска")
-    plt.xlabel("Год выпуска")
-    plt.ylabel("Цена (USD)")
-    plt.grid(True, alpha=0.3)
+    fig, ax = _new_figure((9, 4))
+    ax.scatter(data["year"], data["price_usd"], alpha=0.8)
+    ax.set_title("Зависимость цены от года выпуска")
+    ax.set_xlabel("Год выпуска")
+    ax.set_ylabel("Цена (USD)")
+    ax.grid(True, alpha=0.3)
 
-    return _fig_to_base64(fig)
+    return _fig_to_png_bytes(fig)
 
 
-def price_vs_horsepower() -> str:
+def price_vs_horsepower() -> bytes:
     """
     Зависимость цены от мощности (scatter).
-    Возвращает PNG (base64).
+    Возвращает PNG (bytes).
     """
-    data = df.dropna(subset=["horsepower", "price_usd"]).copy()
+    data = df.dropna(subset=["horsepower", "price_usd"])
     if data.empty:
-        fig = plt.figure(figsize=(8, 3))
-        plt.text(0.5, 0.5, "Нет данных для графика", ha="center", va="center")
-        plt.axis("off")
-        return _fig_to_base64(fig)
-
-    fig = plt.figure(figsize=(9, 4))
-    plt.scatter(data["horsepower"], data["price_usd"], alpha=0.8)
-    plt.title("Зависимость цены от мощности")
-    plt.xlabel("Мощность (л.с.)")
-    plt.ylabel("Цена (USD)")
-    plt.grid(True, alpha=0.3)
-
-    return _fig_to_base64(fig)
+        fig, ax = _new_figure((8, 3))
+        ax.text(0.5, 0.5, "Нет данных для графика", ha="center", va="center")
+        ax.axis("off")
+        return _fig_to_png_bytes(fig)
+
+    fig, ax = _new_figure((9, 4))
+    ax.scatter(data["horsepower"], data["price_usd"], alpha=0.8)
+    ax.set_title("Зависимость цены от мощности")
+    ax.set_xlabel("Мощность (л.с.)")
+    ax.set_ylabel("Цена (USD)")
+    ax.grid(True, alpha=0.3)
+
+    return _fig_to_png_bytes(fig)
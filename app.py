@@ -1,12 +1,13 @@
-from flask import Flask, render_template, request, redirect, url_for, session, send_file, Response, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, Response, jsonify
+import numpy as np
 import pandas as pd
-import io
 import json
-import base64
+from functools import lru_cache
 from pathlib import Path
 from urllib.parse import urlparse
 
 from analysis_utils import (
+    CSV_DTYPES,
     basic_stats,
     price_distribution_by_brand,
     price_vs_year,
@@ -18,17 +19,49 @@ app = Flask(__name__)
 BASE_DIR = Path(__file__).resolve().parent
 DATA_PATH = BASE_DIR / "cars_clean.csv"
 
-df = pd.read_csv(DATA_PATH)
-
-# Нормализуем числовые колонки (чтобы не было 500 из-за типов)
-for col in ["year", "horsepower", "price_usd"]:
-    if col in df.columns:
-        df[col] = pd.to_numeric(df[col], errors="coerce")
+df = pd.read_csv(DATA_PATH, dtype=CSV_DTYPES)
 
 # Добавляем id каждой строке (для избранного и рекомендаций)
 if "id" not in df.columns:
     df = df.reset_index().rename(columns={"index": "id"})
 df["id"] = pd.to_numeric(df["id"], errors="coerce").fillna(0).astype(int)
+ID_INDEX = pd.Index(df["id"])
+
+# Строки df как готовые dict'ы — для шаблонов берём их по позиции
+# (у df RangeIndex, поэтому метка строки совпадает с её позицией)
+RECORDS = df.to_dict(orient="records")
+
+# Списки для выпадающих меню (df статичен — считаем один раз при старте)
+BRANDS = sorted(df["brand"].dropna().unique())
+ALL_MODELS = sorted(df["model"].dropna().unique())
+
+# модели по маркам (для зависимого select)
+MODELS_BY_BRAND = (
+    df.dropna(subset=["brand", "model"])
+    .drop_duplicates(["brand", "model"])
+    .sort_values("model")
+    .groupby("brand", observed=True)["model"]
+    .apply(list)
+    .to_dict()
+)
+
+BODY_TYPES = sorted(df["body_type"].dropna().unique())
+FUEL_TYPES = sorted(df["fuel_type"].dropna().unique())
+DRIVE_TYPES = sorted(df["drive_type"].dropna().unique())
+TRANSMISSIONS = sorted(df["transmission"].dropna().unique())
+
+# JSON для фронта (через data-* чтобы не ломалось)
+MODELS_BY_BRAND_JSON = json.dumps(MODELS_BY_BRAND, ensure_ascii=False)
+MODELS_JSON = json.dumps(ALL_MODELS, ensure_ascii=False)
+
+# Текст для поиска (q): все текстовые поля строки в нижнем регистре,
+# склеенные NumPy-операциями над строками (пропуски — пустые строки)
+SEARCH_COLS = ["brand", "model", "body_type", "fuel_type", "drive_type", "transmission"]
+HAYSTACK = df[SEARCH_COLS[0]].to_numpy(dtype=object, na_value="").astype(str)
+for col in SEARCH_COLS[1:]:
+    part = df[col].to_numpy(dtype=object, na_value="").astype(str)
+    HAYSTACK = np.char.add(np.char.add(HAYSTACK, " "), part)
+HAYSTACK = np.char.lower(HAYSTACK)
 
 
 def _to_int(x):
@@ -43,6 +76,13 @@ def _to_int(x):
         return None
 
 
+def _json_str(value: str) -> str:
+    """json.dumps для строки; печатный ASCII экранируем сами, без JSON-кодировщика."""
+    if value.isascii() and value.isprintable():
+        return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+    return json.dumps(value, ensure_ascii=False)
+
+
 def _safe_next(next_url: str):
     """Разрешаем редирект только на внутренний путь вида '/...'."""
     if not next_url:
@@ -55,6 +95,51 @@ def _safe_next(next_url: str):
     return next_url
 
 
+EQ_COLS = ["brand", "model", "body_type", "fuel_type", "drive_type", "transmission"]
+RANGE_COLS = ["year", "horsepower", "price_usd"]
+
+
+def _positions_by_value(series):
+    """{значение: позиции строк}. Для category считаем по целым кодам, без groupby."""
+    if not isinstance(series.dtype, pd.CategoricalDtype):
+        return series.groupby(series, observed=True).indices
+
+    codes = series.cat.codes.to_numpy()  # -1 — NaN, после сортировки они в начале
+    order = np.argsort(codes, kind="stable")
+    bounds = np.searchsorted(codes[order], np.arange(len(series.cat.categories) + 1))
+    return {
+        value: order[bounds[i]:bounds[i + 1]]
+        for i, value in enumerate(series.cat.categories)
+        if bounds[i] < bounds[i + 1]
+    }
+
+
+def _build_lookup(frame):
+    """
+    Индексы для быстрых фильтров по frame:
+    - eq: {колонка: {значение: позиции строк}} для фильтров на равенство
+    - rng: {колонка: (позиции, отсортированные значения)} без NaN — для searchsorted
+    """
+    eq = {col: _positions_by_value(frame[col]) for col in EQ_COLS}
+
+    rng = {}
+    for col in RANGE_COLS:
+        values = frame[col].to_numpy(dtype=float, na_value=np.nan)
+        order = np.argsort(values, kind="stable")
+        n_valid = int(np.count_nonzero(~np.isnan(values)))  # NaN уходят в конец
+        rng[col] = (order[:n_valid], values[order[:n_valid]])
+
+    return eq, rng
+
+
+LOOKUP = _build_lookup(df)
+_NO_ROWS = np.array([], dtype=np.intp)
+
+# Для рекомендаций: позиции строк по (марка, кузов) и числа как float-массивы
+GROUP_IDX = df.groupby(["brand", "body_type"], observed=True).indices
+NUMERIC = {col: df[col].to_numpy(dtype=float, na_value=np.nan) for col in RANGE_COLS}
+
+
 def apply_filters(
     data,
     q=None,
@@ -64,83 +149,76 @@ def apply_filters(
     price_min=None, price_max=None,
     fuel_type=None, drive_type=None, transmission=None
 ):
-    """Фильтрация + поиск по тексту (q)."""
-    filtered = data.copy()
+    """Фильтрация + поиск по тексту (q).
+
+    Каждое условие даёт набор позиций строк (через индексы LOOKUP),
+    наборы пересекаются. Возвращает отсортированные позиции подходящих
+    строк data (np.ndarray) — нужные колонки вызывающий код берёт сам.
+    """
+    eq_index, range_index = LOOKUP if data is df else _build_lookup(data)
+    selections = []
 
     # ---- Поиск (q) ----
     if q and str(q).strip():
-        terms = str(q).strip().lower().split()
-        search_cols = ["brand", "model", "body_type", "fuel_type", "drive_type", "transmission"]
-
-        haystack = (
-            filtered[search_cols]
-            .astype(str)
-            .agg(" ".join, axis=1)
-            .str.lower()
-        )
+        # длинные слова обычно отсекают больше строк — проверяем их первыми
+        terms = sorted(set(str(q).strip().lower().split()), key=len, reverse=True)
+        haystack = HAYSTACK if data is df else HAYSTACK[data.index.to_numpy()]
 
-        mask = pd.Series(True, index=filtered.index)
+        # каждое следующее слово ищем только среди уже подошедших строк
+        survivors = None
         for term in terms:
-            mask &= haystack.str.contains(term, na=False)
-
-        filtered = filtered[mask]
+            subset = haystack if survivors is None else haystack[survivors]
+            hits = np.char.find(subset, term) >= 0
+            survivors = np.flatnonzero(hits) if survivors is None else survivors[hits]
+            if len(survivors) == 0:
+                break
+        selections.append(survivors)
 
     # ---- Фильтры по полям ----
-    if brand:
-        filtered = filtered[filtered["brand"] == brand]
-    if model:
-        filtered = filtered[filtered["model"] == model]
-    if body_type:
-        filtered = filtered[filtered["body_type"] == body_type]
-    if fuel_type:
-        filtered = filtered[filtered["fuel_type"] == fuel_type]
-    if drive_type:
-        filtered = filtered[filtered["drive_type"] == drive_type]
-    if transmission:
-        filtered = filtered[filtered["transmission"] == transmission]
-
-    y_min = _to_int(year_min)
-    y_max = _to_int(year_max)
-    hp_min_i = _to_int(hp_min)
-    hp_max_i = _to_int(hp_max)
-    p_min = _to_int(price_min)
-    p_max = _to_int(price_max)
-
-    if y_min is not None:
-        filtered = filtered[filtered["year"] >= y_min]
-    if y_max is not None:
-        filtered = filtered[filtered["year"] <= y_max]
-
-    if hp_min_i is not None:
-        filtered = filtered[filtered["horsepower"] >= hp_min_i]
-    if hp_max_i is not None:
-        filtered = filtered[filtered["horsepower"] <= hp_max_i]
-
-    if p_min is not None:
-        filtered = filtered[filtered["price_usd"] >= p_min]
-    if p_max is not None:
-        filtered = filtered[filtered["price_usd"] <= p_max]
-
-    return filtered
+    for col, value in (
+        ("brand", brand),
+        ("model", model),
+        ("body_type", body_type),
+        ("fuel_type", fuel_type),
+        ("drive_type", drive_type),
+        ("transmission", transmission),
+    ):
+        if value:
+            selections.append(eq_index[col].get(value, _NO_ROWS))
+
+    for col, lo, hi in (
+        ("year", year_min, year_max),
+        ("horsepower", hp_min, hp_max),
+        ("price_usd", price_min, price_max),
+    ):
+        lo = _to_int(lo)
+        hi = _to_int(hi)
+        if lo is None and hi is None:
+            continue
+        order, values = range_index[col]
+        start = 0 if lo is None else np.searchsorted(values, lo, side="left")
+        stop = len(values) if hi is None else np.searchsorted(values, hi, side="right")
+        selections.append(order[start:stop])
+
+    if not selections:
+        return np.arange(len(data))
+
+    # Пересечение: начинаем с самого маленького набора (сортируем только его —
+    # порядок строк как в data), остальные проверяем через булеву маску-битсет
+    selections.sort(key=len)
+    positions = np.sort(selections[0])
+    hit = np.zeros(len(data), dtype=bool)
+    for sel in selections[1:]:
+        if len(positions) == 0:
+            break
+        hit[sel] = True
+        positions = positions[hit[positions]]
+        hit[sel] = False
+    return positions
 
 
 @app.route("/", methods=["GET"])
 def index():
-    brands = sorted(df["brand"].dropna().unique())
-    all_models = sorted(df["model"].dropna().unique())
-
-    # модели по маркам (для зависимого select)
-    models_by_brand = (
-        df.groupby("brand")["model"]
-        .apply(lambda s: sorted(s.dropna().unique()))
-        .to_dict()
-    )
-
-    body_types = sorted(df["body_type"].dropna().unique())
-    fuel_types = sorted(df["fuel_type"].dropna().unique())
-    drive_types = sorted(df["drive_type"].dropna().unique())
-    transmissions = sorted(df["transmission"].dropna().unique())
-
     stats = basic_stats()
 
     keys = [
@@ -150,7 +228,7 @@ def index():
     ]
     filters = {k: (request.args.get(k, "") or "") for k in keys}
 
-    filtered_cars = apply_filters(
+    positions = apply_filters(
         df,
         q=filters["q"],
         brand=filters["brand"],
@@ -167,25 +245,22 @@ def index():
         transmission=filters["transmission"],
     )
 
-    # JSON для фронта (через data-* чтобы не ломалось)
-    models_by_brand_json = json.dumps(models_by_brand, ensure_ascii=False)
-    models_json = json.dumps(all_models, ensure_ascii=False)
-    saved_model_json = json.dumps(filters.get("model", ""), ensure_ascii=False)
+    saved_model_json = _json_str(filters.get("model", ""))
 
     favorites = session.get("favorites", [])
 
     return render_template(
         "index.html",
-        cars=filtered_cars.to_dict(orient="records"),
+        cars=[RECORDS[i] for i in positions.tolist()],
         stats=stats,
-        brands=brands,
-        body_types=body_types,
-        fuel_types=fuel_types,
-        drive_types=drive_types,
-        transmissions=transmissions,
+        brands=BRANDS,
+        body_types=BODY_TYPES,
+        fuel_types=FUEL_TYPES,
+        drive_types=DRIVE_TYPES,
+        transmissions=TRANSMISSIONS,
         filters=filters,
-        models_by_brand_json=models_by_brand_json,
-        models_json=models_json,
+        models_by_brand_json=MODELS_BY_BRAND_JSON,
+        models_json=MODELS_JSON,
         saved_model_json=saved_model_json,
         favorites=favorites,
     )
@@ -193,14 +268,9 @@ def index():
 
 @app.route("/favorites/toggle/<int:car_id>", methods=["GET"])
 def toggle_favorite(car_id):
-    favorites = session.get("favorites", [])
-
-    if car_id in favorites:
-        favorites.remove(car_id)
-    else:
-        favorites.append(car_id)
-
-    session["favorites"] = favorites
+    favorites = set(session.get("favorites", []))
+    favorites.symmetric_difference_update({car_id})
+    session["favorites"] = sorted(favorites)
 
     next_url = _safe_next(request.args.get("next") or request.referrer or url_for("index"))
     return redirect(next_url)
@@ -209,44 +279,52 @@ def toggle_favorite(car_id):
 @app.route("/favorites", methods=["GET"])
 def favorites():
     favorites_ids = session.get("favorites", [])
-    fav_cars = df[df["id"].isin(favorites_ids)]
-    return render_template("favorites.html", cars=fav_cars.to_dict(orient="records"))
+    positions = ID_INDEX.get_indexer(favorites_ids)
+    positions = np.sort(positions[positions >= 0])  # -1 — id нет в df
+    return render_template("favorites.html", cars=[RECORDS[i] for i in positions.tolist()])
 
 
 @app.route("/recommend/<int:car_id>", methods=["GET"])
 def recommend(car_id):
-    car_row = df[df["id"] == car_id]
-    if car_row.empty:
+    pos = ID_INDEX.get_indexer([car_id])[0]
+    if pos < 0:
         return "Машина не найдена", 404
 
-    car = car_row.iloc[0]
-    year = car["year"]
-    hp = car["horsepower"]
-    price = car["price_usd"]
+    car = RECORDS[pos]
+    year = NUMERIC["year"][pos]
+    hp = NUMERIC["horsepower"][pos]
+    price = NUMERIC["price_usd"][pos]
 
     # Похожие: та же марка и кузов, год ±1, мощность ±20%
-    similar = df[
-        (df["brand"] == car["brand"]) &
-        (df["body_type"] == car["body_type"]) &
-        (df["year"].between(year - 1, year + 1)) &
-        (df["horsepower"].between(hp * 0.8, hp * 1.2)) &
-        (df["id"] != car_id)
-    ]
-
-    # Цена ±10%
-    price_range_cars = df[
-        (df["price_usd"].between(price * 0.9, price * 1.1)) &
-        (df["id"] != car_id)
-    ]
+    idx = GROUP_IDX.get((car["brand"], car["body_type"]), _NO_ROWS)
+    years = NUMERIC["year"][idx]
+    hps = NUMERIC["horsepower"][idx]
+    similar = idx[np.logical_and.reduce([
+        years >= year - 1,
+        years <= year + 1,
+        hps >= hp * 0.8,
+        hps <= hp * 1.2,
+        idx != pos,
+    ])]
+
+    # Цена ±10%: диапазон в отсортированных ценах (NaN там нет)
+    order, prices = LOOKUP[1]["price_usd"]
+    start = np.searchsorted(prices, price * 0.9, side="left")
+    stop = np.searchsorted(prices, price * 1.1, side="right")
+    price_range_cars = np.sort(order[start:stop])
+    price_range_cars = price_range_cars[price_range_cars != pos]
 
     return render_template(
         "recommend.html",
-        car=car.to_dict(),
-        similar_cars=similar.to_dict(orient="records"),
-        price_range_cars=price_range_cars.to_dict(orient="records"),
+        car=car,
+        similar_cars=[RECORDS[i] for i in similar.tolist()],
+        price_range_cars=[RECORDS[i] for i in price_range_cars.tolist()],
     )
 
 
+EXPORT_CHUNK_ROWS = 10_000
+
+
 @app.route("/export", methods=["GET"])
 def export():
     """Экспорт по текущим фильтрам (из URL) в CSV через GET."""
@@ -257,7 +335,7 @@ def export():
     ]
     filters = {k: (request.args.get(k, "") or "") for k in keys}
 
-    filtered_cars = apply_filters(
+    positions = apply_filters(
         df,
         q=filters["q"],
         brand=filters["brand"],
@@ -274,31 +352,44 @@ def export():
         transmission=filters["transmission"],
     )
 
-    buf = io.StringIO()
-    filtered_cars.to_csv(buf, index=False)
-    buf.seek(0)
+    def generate():
+        # заголовок, затем строки кусками — CSV целиком в памяти не собирается
+        yield df.head(0).to_csv(index=False)
+        for start in range(0, len(positions), EXPORT_CHUNK_ROWS):
+            chunk = df.iloc[positions[start:start + EXPORT_CHUNK_ROWS]]
+            yield chunk.to_csv(header=False, index=False)
 
-    return send_file(
-        io.BytesIO(buf.getvalue().encode("utf-8")),
+    return Response(
+        generate(),
         mimetype="text/csv",
-        as_attachment=True,
-        download_name="filtered_cars.csv",
+        headers={"Content-Disposition": "attachment; filename=filtered_cars.csv"},
     )
 
 
+PLOTS = {
+    "brand_price": price_distribution_by_brand,
+    "price_year": price_vs_year,
+    "price_hp": price_vs_horsepower,
+}
+
+
+@lru_cache(maxsize=None)
+def _plot_png(name) -> bytes:
+    """
+    Графики строятся по статичному df — рендерим PNG один раз, при первом
+    запросе (так matplotlib не грузится при старте, если графики не нужны).
+    """
+    return PLOTS[name]()
+
+
 @app.route("/plot/<name>", methods=["GET"])
 def plot(name):
     """ВАЖНО: отдаём настоящий PNG, а не HTML — чтобы не было image errors."""
-    if name == "brand_price":
-        img_b64 = price_distribution_by_brand()
-    elif name == "price_year":
-        img_b64 = price_vs_year()
-    elif name == "price_hp":
-        img_b64 = price_vs_horsepower()
-    else:
+    if name not in PLOTS:
         return "Unknown plot", 404
 
-    img_bytes = base64.b64decode(img_b64)
+    img_bytes = _plot_png(name)
+
     return Response(img_bytes, mimetype="image/png")
 
 
@@ -324,12 +415,18 @@ def api_search():
     if len(q) < 2 and not brand:
         return jsonify([])
 
-    result = apply_filters(df, q=q, brand=brand)
+    positions = apply_filters(df, q=q, brand=brand)
 
-    cols = ["id", "brand", "model", "year", "price_usd", "body_type"]
-    for c in cols:
-        if c not in result.columns:
-            result[c] = ""
+    # top-k самых дешёвых: argpartition вместо полной сортировки
+    prices = NUMERIC["price_usd"][positions]
+    if len(positions) > limit:
+        top = np.argpartition(prices, limit - 1)[:limit]
+    else:
+        top = np.arange(len(positions))
+    top = top[np.lexsort((positions[top], prices[top]))]  # по цене, при равенстве — по порядку в df
 
-    result = result.sort_values(by="price_usd", ascending=True).head(limit)
-    return jsonify(result[cols].to_dict(orient="records"))
+    cols = ["id", "brand", "model", "year", "price_usd", "body_type"]
+    return jsonify([
+        {c: RECORDS[i].get(c, "") for c in cols}
+        for i in positions[top].tolist()
+    ])